@@ -36,21 +36,78 @@ __license__ = "ISC"
 __date__ = "2018/02/18"
 __version__ = "0.1"
 
+# the modules needed only by some options or fallbacks (urllib.request,
+# hashlib, difflib, selectolax) are imported where used, to keep a cron
+# run with nothing new quick.
 import os
+import re
+import ssl
 import subprocess
 import sys
 import tempfile
+import threading
 from argparse import ArgumentParser, Namespace
-from difflib import context_diff
-from filecmp import cmp
-from http.client import HTTPResponse
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from email.message import Message
+from functools import lru_cache
+from http import HTTPStatus
+from http.client import (HTTPConnection, HTTPException, HTTPResponse,
+                         HTTPSConnection)
+from io import StringIO
+from mmap import ACCESS_READ, mmap
 from pathlib import Path
 from platform import machine
-from re import findall
-from shutil import move, rmtree, which
+from random import uniform
+from shutil import copyfileobj, move, rmtree, which
 from time import sleep
-from typing import Dict, List, Optional, Tuple, Union
-from urllib import request, error, parse
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+from urllib import error, parse
+
+# idle keep-alive connections, by (scheme, host), shared by all the requests
+# of the same run to avoid a new TCP+TLS handshake per document/file.
+_POOL: Dict[Tuple[str, str], List[HTTPConnection]] = {}
+_POOL_LOCK = threading.Lock()
+_POOL_MAXSIZE = 8
+_MAX_REDIRECTS = 5
+_USER_AGENT = f"mutatio/{__version__}"
+# cache validators: response header -> (saved file suffix, request header)
+_VALIDATORS = {
+    "ETag": ("etag", "If-None-Match"),
+    "Last-Modified": ("last-modified", "If-Modified-Since"),
+}
+_SNAPSHOT_DOWNLOADS = 4
+# seconds to wait before each retry of the corrupted snapshot files
+_RETRY_DELAYS = (30, 90, 240)
+
+# use selectolax, or w3m, if available to remove html tags in diff output
+# for readability. Some notification daemons like dunst support html tags
+# output and that's not a problem, but if you are going to use the mail
+# option, then it looks better as plain text. selectolax is preferred
+# because it converts in-process, without spawning a w3m per document.
+_W3M = which("w3m")
+_W3M_CMD = [_W3M, "-dump", "-cols", "80", "-O", "ascii", "-T", "text/html"]
+# the elements that break the lines in selectolax's text conversion
+_HTML_BLOCK_TAGS = frozenset([
+    "address", "article", "aside", "blockquote", "caption", "dd", "div",
+    "dl", "dt", "fieldset", "figcaption", "figure", "footer", "form", "h1",
+    "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol",
+    "p", "pre", "section", "table", "tbody", "tfoot", "thead", "tr", "ul",
+])
+
+# diff (if available) to get the document changes in the same context
+# format than difflib.context_diff does, when both versions end with a
+# newline (see get_document_changes).
+_DIFF = which("diff")
+_DIFF_CMD = [_DIFF, "-c", "-L", "previous", "-L", "current"]
+
+# the file names in a signify signed SHA256 checksums file, e.g.
+# SHA256 (base63.tgz) = ...
+_SIGNIFY_FILES_RE = re.compile(r"\(([^)]+)\)")
+_SIGNIFY_CHECKSUMS_RE = re.compile(
+    r"^SHA256 \(([^)]+)\) = ([0-9a-f]{64})$",
+    re.MULTILINE
+)
 
 
 def arguments() -> ArgumentParser:
@@ -106,68 +163,309 @@ def internet_is_up() -> bool:
     return True if status == 0 else False
 
 
-def get_document(url: str) -> List[str]:
-    """Retrieve a document from a given URL.
+@lru_cache(maxsize=None)
+def get_ssl_context() -> ssl.SSLContext:
+    """Get the TLS context shared by all the HTTPS connections.
 
-    url -- the document URL
+    The CA certificates are loaded only once, the first time that an
+    HTTPS connection is needed, instead of once per new connection.
+
+    """
+    return ssl.create_default_context()
+
+
+def get_connection(scheme: str, host: str) -> Tuple[HTTPConnection, bool]:
+    """Get an idle connection from the pool or a new one if there is none.
+
+    Returns the connection and if it has been reused from the pool.
+
+    scheme -- the URL scheme (http|https)
+    host -- the URL host (and port, if any)
 
     """
-    # use w3m if available to remove html tags in diff output for readability.
-    # Some notification daemons like dunst support html tags output and
-    # that's not a problem, but if you are going to use the mail
-    # option, then it looks better with w3m's conversion to ASCII output.
-    w3m_is_installed = which("w3m")
+    with _POOL_LOCK:
+        idle = _POOL.get((scheme, host))
+        if idle:
+            return idle.pop(), True
+    if scheme == "https":
+        return HTTPSConnection(host, context=get_ssl_context()), False
+    return HTTPConnection(host), False
+
+
+def release_connection(scheme: str, host: str, conn: HTTPConnection) -> None:
+    """Give back a connection to the pool to be reused later.
+
+    scheme -- the URL scheme (http|https)
+    host -- the URL host (and port, if any)
+    conn -- the connection to keep alive
+
+    """
+    with _POOL_LOCK:
+        idle = _POOL.setdefault((scheme, host), [])
+        if len(idle) < _POOL_MAXSIZE:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+@lru_cache(maxsize=None)
+def use_proxy(scheme: str, host: str) -> bool:
+    """Check if a proxy has to be used for a host (e.g. via https_proxy).
+
+    scheme -- the URL scheme (http|https)
+    host -- the URL host name
+
+    """
+    # out of macOS and Windows the proxies only come from the environment,
+    # then urllib.request is only imported if there is some proxy to use.
+    if sys.platform not in ("darwin", "win32") and not any(
+            k.lower() == f"{scheme}_proxy" and v for k, v in os.environ.items()
+    ):
+        return False
+    from urllib import request
+    return scheme in request.getproxies() and not request.proxy_bypass(host)
+
+
+@contextmanager
+def open_url(url: str, headers: Optional[Dict[str, str]]=None
+             ) -> Iterator[HTTPResponse]:
+    """Open a URL reusing a persistent (keep-alive) connection to its host.
+
+    Raises the same exceptions than urllib.request.urlopen. Non HTTP
+    URLs and the ones that have to go through a proxy are opened with
+    urllib.request.urlopen instead. The connection is only given back to
+    the pool if the response was entirely read.
+
+    url -- the URL to open
+    headers -- additional HTTP request headers
+
+    """
+    headers = {"User-Agent": _USER_AGENT, **(headers or {})}
+    for _ in range(_MAX_REDIRECTS + 1):
+        parts = parse.urlsplit(url)
+        if (parts.scheme not in ("http", "https") or
+                use_proxy(parts.scheme, parts.hostname or "")):
+            from urllib import request
+            try:
+                page = request.urlopen(request.Request(url, headers=headers))
+            except error.HTTPError as err:
+                # urllib handles a 304 Not Modified answer as an error
+                if err.code != HTTPStatus.NOT_MODIFIED:
+                    raise
+                page = err
+            with page:
+                yield page
+            return
+        path = parts.path or "/"
+        path = f"{path}?{parts.query}" if parts.query else path
+        conn, reused = get_connection(parts.scheme, parts.netloc)
+        try:
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+            except (HTTPException, OSError):
+                # the server could have closed an idle connection, even
+                # without a clean TLS shutdown (ssl.SSLEOFError is not a
+                # ConnectionError), retry once with a fresh one then.
+                conn.close()
+                if not reused:
+                    raise
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+        except (HTTPException, OSError) as err:
+            conn.close()
+            raise error.URLError(err)
+
+        try:
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader("Location")
+                response.read()
+                if location:
+                    url = parse.urljoin(url, location)
+                    continue
+            if response.status >= 400:
+                response.read()
+                raise error.HTTPError(url, response.status, response.reason,
+                                      response.headers, None)
+            yield response
+            return
+        finally:
+            # readline() does not close a response with a known length
+            # at its end, only read() does.
+            if response.length == 0:
+                response.close()
+            if response.isclosed():
+                release_connection(parts.scheme, parts.netloc, conn)
+            else:
+                conn.close()
+    raise error.URLError(f"too many redirects: {url}")
+
+
+def split_lines(text: str) -> List[str]:
+    """Split a text in lines, keeping the line endings.
+
+    The lines are split in the same way that they are read back from
+    the saved document (universal newlines), to be able to compare
+    them.
+
+    text -- the text to split
+
+    """
+    return StringIO(text, newline=None).readlines()
+
+
+@lru_cache(maxsize=None)
+def get_html_parser() -> Optional[Callable]:
+    """Get selectolax's HTML parser, or None if it is not installed."""
     try:
-        with request.urlopen(url) as page:
-            if isinstance(page, HTTPResponse):
-                content_type = page.getheader("Content-Type")
-            if content_type == "text/html":
-                if w3m_is_installed:
-                    proc = subprocess.Popen(
-                        "w3m -dump -cols 80 -O ascii -T text/html".split(),
-                        stdin=subprocess.PIPE,
-                        stdout=subprocess.PIPE
-                    )
-                    output = proc.communicate(input=page.read())
-                    content = [
-                        f"{i}\n"
-                        for i
-                        in output[0].decode("ascii").split("\n")
-                    ]
-                else:
-                    content = [
-                        i.decode("utf-8", errors="ignore")
-                        for i
-                        in page.readlines()
-                    ]
+        from selectolax.lexbor import LexborHTMLParser
+    except ImportError:
+        return None
+    return LexborHTMLParser
+
+
+def html_to_text(html: bytes) -> str:
+    """Get the text of an HTML document, without blank lines.
+
+    The inline elements are joined in the same line, the lines are only
+    broken by block elements and <br>, and the table cells of a row are
+    separated by a space. The whitespace is collapsed but in <pre>.
+
+    html -- the HTML document
+
+    """
+    tree = get_html_parser()(html)
+    tree.strip_tags(["script", "style"])
+    lines: List[str] = []
+    current: List[str] = []
+
+    def flush(pre: bool) -> None:
+        text = "".join(current)
+        text = text.rstrip() if pre else " ".join(text.split())
+        if text.strip():
+            lines.append(f"{text}\n")
+        current.clear()
+
+    def walk(node, pre: bool) -> None:
+        for child in node.iter(include_text=True):
+            if child.is_text_node and pre:
+                first, *others = (child.text_content or "").split("\n")
+                current.append(first)
+                for text in others:
+                    flush(pre)
+                    current.append(text)
+            elif child.is_text_node:
+                current.append(child.text_content or "")
+            elif child.tag == "br":
+                flush(pre)
+            elif child.tag in _HTML_BLOCK_TAGS:
+                flush(pre)
+                walk(child, pre or child.tag == "pre")
+                flush(pre or child.tag == "pre")
             else:
-                content = [
-                    i.decode("ascii", errors="ignore")
-                    for i
-                    in page.readlines()
-                ]
-            return content
-    except (ValueError, error.URLError, error.HTTPError) as err:
-        print(err, file=sys.stderr)
-        sys.exit(-2)
+                if child.tag in ("td", "th"):
+                    current.append(" ")
+                walk(child, pre)
+
+    walk(tree.body or tree.root, False)
+    flush(False)
+    return "".join(lines)
+
+
+def get_document(url: str, headers: Optional[Dict[str, str]]=None
+                 ) -> Tuple[Optional[List[str]], Message]:
+    """Retrieve a document from a given URL, and its response headers.
+
+    The document is None if it was not modified since the conditional
+    request headers given. Raises the same exceptions than open_url,
+    to let the caller decide how to handle a failed retrieval.
+
+    url -- the document URL
+    headers -- the conditional request headers, if any
+
+    """
+    with open_url(url, headers) as page:
+        if page.getcode() == HTTPStatus.NOT_MODIFIED:
+            return None, page.headers
+        # without parameters, e.g. "text/html; charset=utf-8"
+        content_type = page.headers.get_content_type()
+        if content_type == "text/html":
+            if get_html_parser():
+                content = split_lines(html_to_text(page.read()))
+            elif _W3M:
+                proc = subprocess.Popen(
+                    _W3M_CMD,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE
+                )
+                output = proc.communicate(input=page.read())
+                content = split_lines(output[0].decode("ascii"))
+            else:
+                content = split_lines(
+                    page.read().decode("utf-8", errors="ignore")
+                )
+        else:
+            content = split_lines(
+                page.read().decode("ascii", errors="ignore")
+            )
+        return content, page.headers
 
 
-def get_document_changes(previous: str, current: List[str], url: str) -> str:
+def end_with_newline(lines: List[str]) -> List[str]:
+    """Ensure that the last line of a document ends with a newline.
+
+    lines -- the document lines
+
+    """
+    if lines and not lines[-1].endswith("\n"):
+        return lines[:-1] + [f"{lines[-1]}\n"]
+    return lines
+
+
+def get_document_changes(previous: List[str], current: List[str], url: str,
+                         previous_file: str="") -> str:
     """Get the differences between versions of the same document.
 
-    previous -- the file name of the previous document version
+    previous -- the previous document version
     current -- the current document version
     url -- the document's URL
+    previous_file -- the file name of the previous document version, if saved
 
     """
-    changes = "".join(
-        context_diff(
-            open(previous, "r").readlines(),
-            current,
-            fromfile="previous",
-            tofile="current"
+    # both versions have to end with a newline to get the same output
+    # from diff and difflib, diff would add "\ No newline at end of file"
+    # lines otherwise. The saved file is given to diff as is, then it's
+    # only used if it already ends with a newline.
+    previous_file_ends = not previous or previous[-1].endswith("\n")
+    previous, current = end_with_newline(previous), end_with_newline(current)
+
+    # most of the times there are no changes at all, then there is no
+    # need to look for the differences line by line.
+    if previous == current:
+        return ""
+
+    # use diff if available, it's way faster than difflib for big
+    # documents and its context format output is the same.
+    proc = None
+    if _DIFF and previous_file and previous_file_ends:
+        proc = subprocess.run(
+            _DIFF_CMD + [previous_file, "-"],
+            input="".join(current),
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+    if proc and proc.returncode in (0, 1):
+        changes = proc.stdout
+    else:
+        from difflib import context_diff
+        changes = "".join(
+            context_diff(
+                previous,
+                current,
+                fromfile="previous",
+                tofile="current"
+            )
         )
-    )
 
     # I append the document URL to the output because some
     # notification daemons like dunst allows us to open it in a
@@ -175,22 +473,76 @@ def get_document_changes(previous: str, current: List[str], url: str) -> str:
     return changes + os.linesep + url if changes else changes
 
 
+def get_conditional_headers(doc_name: str) -> Dict[str, str]:
+    """Get the conditional request headers for a saved document.
+
+    Only the validators given by the server and saved aside are echoed,
+    never a date from the local clock.
+
+    doc_name -- the saved document file name
+
+    """
+    headers = {}
+    for suffix, request_header in _VALIDATORS.values():
+        validator_file = Path(f"{doc_name}.{suffix}")
+        if validator_file.exists():
+            headers[request_header] = validator_file.read_text()
+    return headers
+
+
+def save_validators(doc_name: str, headers: Message) -> None:
+    """Save aside the cache validators given by the server for a document.
+
+    doc_name -- the saved document file name
+    headers -- the document's response headers
+
+    """
+    for response_header, (suffix, _) in _VALIDATORS.items():
+        validator, validator_file = (
+            headers.get(response_header),
+            Path(f"{doc_name}.{suffix}")
+        )
+        if validator:
+            validator_file.write_text(validator)
+        elif validator_file.exists():
+            validator_file.unlink()
+
+
 def get_update_info(url: str) -> Tuple[str, Optional[str]]:
     """Get the document changes and its status.
 
     url -- the current document url
 
     """
-    doc_from_mirror, doc_name = get_document(url), url.split("/")[-1]
+    doc_name = url.split("/")[-1]
+    saved = Path(doc_name).exists()
+    doc_from_mirror, headers = get_document(
+        url,
+        get_conditional_headers(doc_name) if saved else None
+    )
+    if doc_from_mirror is None:
+        return "same", None
+
     status, changes = None, None
-    if not Path(doc_name).exists():
+    if not saved:
         status = "bootstrap"
     else:
-        changes = get_document_changes(doc_name, doc_from_mirror, url)
+        with open(doc_name, "r") as f:
+            previous = f.readlines()
+        changes = get_document_changes(
+            previous,
+            doc_from_mirror,
+            url,
+            doc_name
+        )
         status = "same" if not changes else "new"
     if status in ("new", "bootstrap"):
-        with open(doc_name, "w") as f:
+        # write it aside and rename it after, an interrupted write must
+        # not leave a truncated previous version for the next check.
+        with open(f"{doc_name}.tmp", "w") as f:
             f.writelines(doc_from_mirror)
+        os.replace(f"{doc_name}.tmp", doc_name)
+    save_validators(doc_name, headers)
     return status, changes
 
 
@@ -202,8 +554,8 @@ def get_binary(url: str, filename: Union[Path, str]) -> None:
 
     """
     try:
-        with request.urlopen(url) as binary, open(filename, "wb") as output:
-            output.write(binary.read())
+        with open_url(url) as binary, open(filename, "wb") as output:
+            copyfileobj(binary, output, length=1 << 20)
     except (ValueError, error.URLError, error.HTTPError) as err:
         print(err, file=sys.stderr)
         sys.exit(-2)
@@ -221,12 +573,40 @@ def download_snapshot(url: str, signify_file: str, directory: str) -> Path:
     signify_file_path = subdir / signify_file
     subdir.mkdir()
     get_binary(parse.urljoin(url, signify_file), signify_file_path)
-    files = findall("\((.*)\)", open(signify_file_path).read())
-    for f in files:
-        get_binary(parse.urljoin(url, f), subdir / f)
+    with open(signify_file_path) as checksums:
+        files = _SIGNIFY_FILES_RE.findall(checksums.read())
+    # a few concurrent downloads to use the bandwidth better, but not too
+    # many to be polite with the mirror.
+    # On the first failed download, the pending ones are cancelled
+    # instead of downloading a set that is going to be discarded.
+    with ThreadPoolExecutor(max_workers=_SNAPSHOT_DOWNLOADS) as executor:
+        downloads = [
+            executor.submit(get_binary, parse.urljoin(url, f), subdir / f)
+            for f in files
+        ]
+        done, pending = wait(downloads, return_when=FIRST_EXCEPTION)
+        for download in pending:
+            download.cancel()
+        for download in done:
+            download.result()
     return subdir
 
 
+@lru_cache(maxsize=None)
+def get_signify_key(key_dir: str, snapshot: Path) -> str:
+    """Get the signify public key for the release of a given snapshot.
+
+    The snapshot could be from a newer release than the running one.
+
+    key_dir -- the directory where the signify public keys are stored
+    snapshot -- the directory where the snapshot is stored
+
+    """
+    # e.g. base63.tgz -> 63
+    snapshot_release = next(snapshot.glob("base*.tgz")).stem[len("base"):]
+    return Path(key_dir, f"openbsd-{snapshot_release}-base.pub").as_posix()
+
+
 def verify(signify: Dict[str, str], snapshot: Path,
            filename: str="") -> Tuple[bool, List[str]]:
     """Verify the integrity of a given snapshot with signify.
@@ -237,26 +617,66 @@ def verify(signify: Dict[str, str], snapshot: Path,
 
     """
     os.chdir(snapshot)
-    snapshot_release = list(
-        Path('.').glob('base*.tgz')
-    )[0].as_posix().rstrip('.tgz').lstrip('base')
-    signify_key = Path(
-        signify['key_dir'],
-        f"/etc/signify/openbsd-{snapshot_release}-base.pub"
-    ).as_posix()
-    command = f"signify -Cp {signify_key} -x {signify['file']} {filename}"
-    status = subprocess.getstatusoutput(command)
+    signify_key = get_signify_key(signify["key_dir"], snapshot)
+    command = ["signify", "-Cp", signify_key, "-x", signify["file"]]
+    if filename:
+        command.append(filename)
+    status = subprocess.run(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True
+    )
     failed = [
-        i.split(":")[0]
+        i.split(":", 1)[0]
         for i
-        in status[1].split(os.linesep)
+        in status.stdout.splitlines()
         if i.endswith("FAIL")
     ]
-    return status[0] == 0, failed
+    return status.returncode == 0, failed
+
+
+def get_checksums(signify_file: Union[Path, str]) -> Dict[str, str]:
+    """Get the SHA256 checksums by file name from a signify signed file.
+
+    signify_file -- a signify signed SHA256 checksums file
+
+    """
+    with open(signify_file) as checksums:
+        return dict(_SIGNIFY_CHECKSUMS_RE.findall(checksums.read()))
+
+
+def sha256sum(filename: Union[Path, str]) -> str:
+    """Get the SHA256 checksum of a given file.
+
+    filename -- the file name
+
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_again(files: List[str], checksums: Dict[str, str],
+                   snapshot: Path, url: str) -> List[str]:
+    """Download again some files and return the ones still corrupted.
+
+    files -- the names of the files to download
+    checksums -- the expected SHA256 checksums by file name
+    snapshot -- the directory where the snapshot is stored
+    url -- the snapshots' mirror URL
+
+    """
+    for f in files:
+        get_binary(parse.urljoin(url, f), snapshot / f)
+    return [f for f in files if sha256sum(snapshot / f) != checksums.get(f)]
 
 
 def check_integrity(signify: Dict[str, str], snapshot: Path, url: str) -> bool:
-    """Check the integrity of the snapshot and retry once if failed files.
+    """Check the integrity of the snapshot and retry the failed files.
 
     signify -- the signify key and a signify signed file with SHA256 checksums
     snapshot -- the directory where the snapshot is stored
@@ -264,17 +684,41 @@ def check_integrity(signify: Dict[str, str], snapshot: Path, url: str) -> bool:
 
     """
     whole, failed = verify(signify, snapshot)
-    # if there are some failed files, retry once, five minutes
-    # after. Downloads can fail or just get the mirror in the middle
-    # of a sync.
+    # if there are some failed files, retry them at once and, while they
+    # are still corrupted, a few times more waiting longer each time.
+    # Downloads can fail or just get the mirror in the middle of a
+    # sync. The checksums are checked locally, signify only verifies the
+    # whole set again when all of them match.
     if failed:
-        sleep(300)
-        for f in failed:
-            get_binary(parse.urljoin(url, f), f)
-        whole, failed = verify(signify, snapshot)
+        checksums = get_checksums(snapshot / signify["file"])
+        failed = download_again(failed, checksums, snapshot, url)
+        for delay in _RETRY_DELAYS:
+            if not failed:
+                break
+            sleep(delay + uniform(0, delay / 4))
+            failed = download_again(failed, checksums, snapshot, url)
+        whole = False if failed else verify(signify, snapshot)[0]
     return whole
 
 
+def same_content(first: Union[Path, str], second: Union[Path, str]) -> bool:
+    """Check if two files have the same content, byte by byte.
+
+    first -- the first file name
+    second -- the second file name
+
+    """
+    size = os.path.getsize(first)
+    if size != os.path.getsize(second):
+        return False
+    if not size:
+        return True
+    with open(first, "rb") as f, open(second, "rb") as s, \
+            mmap(f.fileno(), 0, access=ACCESS_READ) as f_map, \
+            mmap(s.fileno(), 0, access=ACCESS_READ) as s_map:
+        return f_map[:] == s_map[:]
+
+
 def is_installed(snapshot: Path) -> bool:
     """Check if a given snapshot is already installed and running.
 
@@ -282,9 +726,9 @@ def is_installed(snapshot: Path) -> bool:
 
     """
     ramdisk_file = "bsd.rd"
-    return cmp(
-        Path(snapshot, ramdisk_file).as_posix(),
-        Path("/", ramdisk_file).as_posix(),
+    return same_content(
+        Path(snapshot, ramdisk_file),
+        Path("/", ramdisk_file),
     )
 
 
@@ -294,11 +738,12 @@ def rotate(snapshots_directory: Path, subdirectories: Dict[str, Path]) -> None:
     snapshots_directory -- the directory where the snapshots are stored
 
     """
+    # all of them are in the same directory, then renaming is enough
     if subdirectories["previous"].exists():
         rmtree(subdirectories["previous"])
     if subdirectories["current"].exists():
-        move(subdirectories["current"], subdirectories["previous"])
-    move(subdirectories["upgrade"], subdirectories["current"])
+        os.replace(subdirectories["current"], subdirectories["previous"])
+    os.replace(subdirectories["upgrade"], subdirectories["current"])
 
 
 def notify(header: str, body: str, urgency: str="normal") -> None:
@@ -344,27 +789,25 @@ def feedback(args: Namespace, title: str, body: str, urgency: str) -> None:
         sys.stdout.writelines(body+os.linesep)
 
 
-def main() -> None:
-    """Main section."""
+@lru_cache(maxsize=None)
+def get_system() -> Tuple[str, str]:
+    """Get the running release (without dots) and machine architecture."""
+    return os.uname().release.replace(".", ""), machine()
 
-    if not internet_is_up():
-        sys.exit()
 
-    args = arguments().parse_args()
+@lru_cache(maxsize=None)
+def get_mirror_url(mirror: Optional[str]) -> str:
+    """Get the mirror URL, ending with a slash.
 
-    current_release = os.uname().release.replace(".", "")
-    architecture = machine()
-    signify = {
-        "key_dir": f"/etc/signify/",
-        "file": "SHA256.sig"
-    }
+    mirror -- the mirror URL, if None the one from /etc/installurl
 
-    # URLs
-    if args.mirror:
-        mirror_url = args.mirror
+    """
+    if mirror:
+        mirror_url = mirror
     else:
         try:
-            mirror_url = open("/etc/installurl").read().rstrip()
+            with open("/etc/installurl") as installurl:
+                mirror_url = installurl.read().rstrip()
             if not mirror_url:
                 print("Your /etc/installurl file is empty.", file=sys.stderr)
                 sys.exit(-2)
@@ -372,8 +815,19 @@ def main() -> None:
             print("You do not have a /etc/installurl file.", file=sys.stderr)
             sys.exit(-2)
     # ensure to have a proper URL to make the joins
-    mirror_url = mirror_url if mirror_url.endswith("/") else f"{mirror_url}/"
+    return mirror_url if mirror_url.endswith("/") else f"{mirror_url}/"
+
+
+@lru_cache(maxsize=None)
+def get_urls(mirror_url: str, architecture: str,
+             current_release: str) -> Dict[str, str]:
+    """Get the URLs of the files to check for updates/download.
 
+    mirror_url -- the mirror URL, ending with a slash
+    architecture -- the machine architecture
+    current_release -- the running release, without dots
+
+    """
     snapshots_url = parse.urljoin(mirror_url, f"snapshots/{architecture}/")
     packages_url = parse.urljoin(
         mirror_url,
@@ -381,8 +835,8 @@ def main() -> None:
     )
     website_url = "https://www.openbsd.org/"
 
-    # files to check for updates/download
-    files_urls = {
+    return {
+        "snapshot_set": snapshots_url,
         "changelog": parse.urljoin(mirror_url, "Changelogs/ChangeLog"),
         "packages": parse.urljoin(packages_url, "index.txt"),
         "snapshots": parse.urljoin(snapshots_url, "BUILDINFO"),
@@ -393,6 +847,28 @@ def main() -> None:
         "current": parse.urljoin(website_url, "faq/current.html"),
     }
 
+
+def main() -> None:
+    """Main section."""
+
+    if not internet_is_up():
+        sys.exit()
+
+    args = arguments().parse_args()
+
+    current_release, architecture = get_system()
+    signify = {
+        "key_dir": f"/etc/signify/",
+        "file": "SHA256.sig"
+    }
+
+    files_urls = get_urls(
+        get_mirror_url(args.mirror),
+        architecture,
+        current_release
+    )
+    snapshots_url = files_urls["snapshot_set"]
+
     # directories
     working_dir = Path(args.path).expanduser()
     snaps_dir = working_dir / "snapshots"
@@ -451,22 +927,43 @@ def main() -> None:
         working_dir.mkdir()
     os.chdir(working_dir)
 
-    # look for changes in all but snapshots
-    for k, v in vars(args).items():
-        if v is True and k in data.keys():
-            status, changes = get_update_info(data[k]["url"])
-
-            if changes:
-                feedback(
-                    args,
-                    data[k]["title"],
-                    changes if not data[k]["body"] else data[k]["body"],
-                    data[k]["level"],
-                )
+    # look for changes in all but snapshots. The documents are retrieved
+    # concurrently, but the feedback is given in the same order always.
+    topics = [k for k, v in vars(args).items() if v is True and k in data]
+    # A failed topic does not prevent the feedback from the others,
+    # their new versions are already saved and would not be notified
+    # again.
+    with ThreadPoolExecutor(max_workers=len(data)) as executor:
+        updates = {
+            topic: executor.submit(get_update_info, data[topic]["url"])
+            for topic in topics
+        }
+
+    failed = False
+    for k, update in updates.items():
+        try:
+            status, changes = update.result()
+        except (ValueError, error.URLError, error.HTTPError) as err:
+            print(err, file=sys.stderr)
+            failed = True
+            continue
+        if changes:
+            feedback(
+                args,
+                data[k]["title"],
+                changes if not data[k]["body"] else data[k]["body"],
+                data[k]["level"],
+            )
+    if failed:
+        sys.exit(-2)
 
     # look for changes in snapshots
     if args.snapshot:
-        status, changes = get_update_info(files_urls["snapshots"])
+        try:
+            status, changes = get_update_info(files_urls["snapshots"])
+        except (ValueError, error.URLError, error.HTTPError) as err:
+            print(err, file=sys.stderr)
+            sys.exit(-2)
         tempfile.tempdir = Path(snaps_dir).as_posix() if args.no_temp else None
 
         if status == "bootstrap":